@@ -1 +1,2 @@
-from .kits19 import KiTS19
+from .kits19 import KiTS19, KiTS19Iter, KiTSSample
+from .loader import CaseBatchSampler, ThreadDataLoader
@@ -1,24 +1,50 @@
+import collections
 import json
+import os
+import threading
 from pathlib2 import Path
 
 import cv2
 import numpy as np
 import torch
-from albumentations import (
-    PadIfNeeded,
-    Compose,
-    Resize
-)
 from torch.utils import data
 
+from dataset.loader import ThreadDataLoader
 from dataset.transform import to_numpy
 
 
+# dtypes cv2.warpAffine takes for bilinear interpolation
+_LINEAR_DTYPES = (np.uint8, np.uint16, np.int16, np.float32, np.float64)
+
+
+def _warp_affine(img, mat, dsize, interpolation):
+    # cv2.warpAffine handles at most 4 channels per call
+    if img.ndim == 3 and img.shape[2] > 4:
+        chunks = [_warp_affine(img[:, :, i:i + 4], mat, dsize, interpolation) for i in range(0, img.shape[2], 4)]
+        return np.concatenate(chunks, axis=2)
+    
+    out = cv2.warpAffine(np.ascontiguousarray(img), mat, dsize, flags=interpolation,
+                         borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    if img.ndim == 3 and out.ndim == 2:
+        out = out[:, :, np.newaxis]
+    return out
+
+
+class KiTSSample(dict):
+    # DataLoader pinning calls pin_memory() below, so only image and label of a sample
+    # or a collated batch are pinned, the index and roi entries stay in pageable memory
+    def pin_memory(self):
+        self['image'] = self['image'].pin_memory()
+        self['label'] = self['label'].pin_memory()
+        return self
+
+
 class KiTS19(data.Dataset):
     def __init__(self, root, stack_num=1, spec_classes=None, img_size=(512, 512),
                  train_case_ids_file='train.txt', valid_case_ids_file='val.txt', test_case_ids_file='test.txt',
                  use_roi=False, roi_file=None, roi_error_range=0,
-                 train_transform=None, valid_transform=None, test_transform=None):
+                 train_transform=None, valid_transform=None, test_transform=None, max_cache_bytes=0,
+                 volume_format=None, defer_resize=False):
         self._root = Path(root)
         self._stack_num = stack_num
         if spec_classes is None:
@@ -27,7 +53,38 @@ class KiTS19(data.Dataset):
             assert len(self.get_classes_name(spec=False)) == len(spec_classes)
             self._spec_classes = spec_classes
         
+        # spec classes without duplicates, in order of first appearance
+        _, first_idx = np.unique(self._spec_classes, return_index=True)
+        self._spec_class_idx = np.array(self._spec_classes)[np.sort(first_idx)]
+        
+        # lookup table from class index to spec class index, None when classes are kept as is
+        self._label_lut = None
+        if self._spec_classes != [0, 1, 2]:
+            spec_class_idx = self._spec_class_idx.tolist()
+            self._label_lut = np.array([spec_class_idx.index(i) for i in self._spec_classes], dtype=np.int64)
+        
+        self._cmap = np.array([[0, 0, 0], [255, 0, 0], [0, 0, 255]], dtype=np.int32)
+        self._spec_cmap = self._cmap[self._spec_class_idx]
+        self._spec_cmap_float = (self._spec_cmap / 255).astype(np.float32)
+        
         self._img_size = img_size
+        self._resize_mats = {}
+        self._label_indices = {}
+        # leave resizing to transform.pad_resize on the collated batch, slices of different cases
+        # can differ in size, so batch them with loader.CaseBatchSampler
+        self._defer_resize = defer_resize
+        
+        # LRU cache of loaded slices, disabled when max_cache_bytes is 0
+        self._max_cache_bytes = max_cache_bytes
+        self._cache = collections.OrderedDict()
+        self._cache_bytes = 0
+        self._cache_lock = threading.Lock()
+        self._npy_headers = {}
+        
+        # read stacks from per-case volumes written by build_cache.py instead of slice files
+        assert volume_format in (None, 'b2nd', 'safetensors')
+        self._volume_format = volume_format
+        self._local = threading.local()
         
         self._use_roi = use_roi
         if use_roi:
@@ -44,17 +101,16 @@ class KiTS19(data.Dataset):
         
         self._get_data(train_case_ids_file, valid_case_ids_file, test_case_ids_file)
         self._split_subset()
+        if use_roi:
+            self._pack_rois()
         
         self._num_classes = len(self.get_classes_name())
-        self._img_channels = self.__getitem__(0)['image'].shape[0]
+        # get_stack_img takes stack_num // 2 slices on each side of the center slice
+        self._img_channels = 2 * (stack_num // 2) + 1
     
     def _get_data(self, train_case_ids_file, valid_case_ids_file, test_case_ids_file):
         def read_txt(file):
-            d = []
-            f = open(file, 'r')
-            for line in f:
-                d.append(int(line))
-            return d
+            return np.loadtxt(str(file), dtype=np.int32, ndmin=1).tolist()
         
         train_case_ids_file = self._root / train_case_ids_file
         valid_case_ids_file = self._root / valid_case_ids_file
@@ -64,76 +120,124 @@ class KiTS19(data.Dataset):
         self._test_case = read_txt(test_case_ids_file)
         self._case_id = self._train_case + self._valid_case + self._test_case
         
-        train_imgs, train_labels, train_case_slice_num = self._read_npy(self._root, self._train_case, is_test=False)
-        valid_imgs, valid_labels, valid_case_slice_num = self._read_npy(self._root, self._valid_case, is_test=False)
-        test_imgs, test_labels, test_case_slice_num = self._read_npy(self._root, self._test_case, is_test=True)
-        
-        self._imgs = train_imgs + valid_imgs + test_imgs
-        self._labels = train_labels + valid_labels + test_labels
-        
-        self._indices = list(range(len(self._imgs)))
-        self._train_indices = self._indices[:len(train_imgs)]
-        self._valid_indices = self._indices[len(train_imgs):len(train_imgs) + len(valid_imgs)]
-        self._test_indices = self._indices[
-                             len(train_imgs) + len(valid_imgs): len(train_imgs) + len(valid_imgs) + len(test_imgs)]
-        
-        idx = 0
-        self._case_slice_indices = [0]
-        self._train_case_slice_indices = [0]
-        for num in train_case_slice_num:
-            idx += num
-            self._case_slice_indices.append(idx)
-            self._train_case_slice_indices.append(idx)
-        
-        self._valid_case_slice_indices = [self._train_case_slice_indices[-1]]
-        for num in valid_case_slice_num:
-            idx += num
-            self._case_slice_indices.append(idx)
-            self._valid_case_slice_indices.append(idx)
-        
-        self._test_case_slice_indices = [self._valid_case_slice_indices[-1]]
-        for num in test_case_slice_num:
-            idx += num
-            self._case_slice_indices.append(idx)
-            self._test_case_slice_indices.append(idx)
-    
-    def _read_npy(self, root, cases, is_test=False):
+        cases_is_test = [False] * (len(self._train_case) + len(self._valid_case)) + [True] * len(self._test_case)
+        imgs, labels, case_slice_num, self._case_min_z = self._read_npy(self._root, self._case_id, cases_is_test)
+        
+        # paths relative to root in flat bytes arrays: forked DataLoader workers read them
+        # without touching refcounts, so the pages stay shared instead of being copied
+        self._root_str = str(self._root)
+        self._img_paths = np.array(imgs, dtype=np.bytes_)
+        self._label_paths = np.array(labels, dtype=np.bytes_)
+        
+        num_train = len(self._train_case)
+        num_valid = len(self._valid_case)
+        self._case_slice_indices = [0] + np.cumsum(case_slice_num, dtype=np.int64).tolist()
+        self._train_case_slice_indices = self._case_slice_indices[:num_train + 1]
+        self._valid_case_slice_indices = self._case_slice_indices[num_train:num_train + num_valid + 1]
+        self._test_case_slice_indices = self._case_slice_indices[num_train + num_valid:]
+        
+        # ranges keep `idx in ...` O(1) and can still be indexed by Subset
+        self._indices = range(len(self._img_paths))
+        self._train_indices = self._indices[:self._valid_case_slice_indices[0]]
+        self._valid_indices = self._indices[self._valid_case_slice_indices[0]:self._test_case_slice_indices[0]]
+        self._test_indices = self._indices[self._test_case_slice_indices[0]:]
+        
+        slice_nums = np.diff(self._case_slice_indices)
+        self._idx2case = np.repeat(np.arange(len(slice_nums)), slice_nums)
+    
+    def _read_npy(self, root, cases, cases_is_test):
+        # slice file names of every case are cached in listing.json together with the mtime of
+        # their directory, a directory is listed again once files were added or removed
+        listing_file = root / 'listing.json'
+        listing = {}
+        if listing_file.exists():
+            try:
+                with open(listing_file, 'r') as f:
+                    listing = json.load(f)
+            except ValueError:
+                listing = {}
+        listing_updated = False
+        
         imgs = []
         labels = []
         case_slice_num = []
-        
-        for case in cases:
-            case_root = root / f'case_{case:05d}'
-            imaging_dir = case_root / 'imaging'
-            assert imaging_dir.exists()
-            case_imgs = sorted(list(imaging_dir.glob('*.npy')))
+        case_min_z = []
+        
+        for case, is_test in zip(cases, cases_is_test):
+            case_name = f'case_{case:05d}'
+            case_root = root / case_name
+            cached = listing.get(case_name)
+            case_listing = self._list_case_slices(case_root, cached)
+            if case_listing != cached:
+                listing_updated = True
+                if 'imaging' in case_listing:
+                    listing[case_name] = case_listing
+                else:
+                    listing.pop(case_name, None)
+            
+            assert 'imaging' in case_listing
+            case_imgs = case_listing['imaging']['files']
             
             min_z = 0
             max_z = len(case_imgs)
             if self._use_roi:
-                roi = self._rois[f'case_{case:05d}']['kidney']
+                roi = self._rois[case_name]['kidney']
                 min_z = max(min_z, roi['min_z'] - self._roi_error_range)
                 max_z = min(max_z, roi['max_z'] + self._roi_error_range)
             
             case_imgs = case_imgs[min_z: max_z]
-            imgs += case_imgs
+            imgs += [os.path.join(case_name, 'imaging', name) for name in case_imgs]
             
             if not is_test:
-                segmentation_dir = case_root / 'segmentation'
-                assert segmentation_dir.exists()
-                case_labels = sorted(list(segmentation_dir.glob('*.npy')))
-                case_labels = case_labels[min_z: max_z]
-                labels += case_labels
+                assert 'segmentation' in case_listing
+                case_labels = case_listing['segmentation']['files'][min_z: max_z]
+                labels += [os.path.join(case_name, 'segmentation', name) for name in case_labels]
                 assert len(imgs) == len(labels)
             
             case_slice_num.append(len(case_imgs))
-        
-        return imgs, labels, case_slice_num
+            case_min_z.append(min_z)
+        
+        if listing_updated:
+            # written aside and moved in place, concurrent runs never see a partial file
+            tmp_file = f'{listing_file}.{os.getpid()}.tmp'
+            try:
+                with open(tmp_file, 'w') as f:
+                    json.dump(listing, f)
+                os.replace(tmp_file, str(listing_file))
+            except OSError:
+                # read-only data directory, the listing is rebuilt next time
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+        
+        return imgs, labels, case_slice_num, case_min_z
+    
+    @staticmethod
+    def _list_case_slices(case_root, cached=None):
+        case_listing = {}
+        for name in ('imaging', 'segmentation'):
+            slice_dir = str(case_root / name)
+            try:
+                mtime = os.stat(slice_dir).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            
+            entry = cached.get(name) if isinstance(cached, dict) else None
+            if not isinstance(entry, dict) or entry.get('mtime') != mtime:
+                files = sorted(e.name for e in os.scandir(slice_dir) if e.name.endswith('.npy'))
+                entry = {'mtime': mtime, 'files': files}
+            case_listing[name] = entry
+        return case_listing
     
     def _split_subset(self):
         self._train_dataset = data.Subset(self, self._train_indices)
         self._valid_dataset = data.Subset(self, self._valid_indices)
         self._test_dataset = data.Subset(self, self._test_indices)
+        
+        self._transform_for_idx = [None] * len(self._img_paths)
+        for indices, transform in ((self._train_indices, self._train_transform),
+                                   (self._valid_indices, self._valid_transform),
+                                   (self._test_indices, self._test_transform)):
+            self._transform_for_idx[indices.start:indices.stop] = [transform] * len(indices)
     
     def get_classes_name(self, spec=True):
         classes_name = np.array(['background', 'kidney', 'tumor'])
@@ -141,90 +245,82 @@ class KiTS19(data.Dataset):
         if not spec:
             return classes_name
         
-        spec_classes_name = []
-        for i in classes_name[self._spec_classes]:
-            if i not in spec_classes_name:
-                spec_classes_name.append(i)
-        return spec_classes_name
+        return classes_name[self._spec_class_idx].tolist()
     
     def get_colormap(self, spec=True):
-        cmap = [[0, 0, 0], [255, 0, 0], [0, 0, 255]]
-        cmap = np.array(cmap, dtype=np.int)
-        
         if not spec:
-            return cmap
+            return self._cmap
         
-        spec_cmap = []
-        for i in cmap[self._spec_classes]:
-            if len(spec_cmap) == 0:
-                spec_cmap.append(i)
-            else:
-                duplicate = False
-                for j in spec_cmap:
-                    duplicate = duplicate or (i == j).all()
-                if not duplicate:
-                    spec_cmap.append(i)
-        return np.array(spec_cmap)
+        return self._spec_cmap
+    
+    def _img_path(self, idx):
+        return os.path.join(self._root_str, self._img_paths[idx].decode())
+    
+    def _label_path(self, idx):
+        return os.path.join(self._root_str, self._label_paths[idx].decode())
+    
+    def _pack_rois(self):
+        # flat arrays instead of the nested roi dict, for the same reason as the slice paths
+        rois = [self._rois[f'case_{case_id:05d}'] for case_id in self._case_id]
+        self._roi_strs = np.array([json.dumps(roi).encode() for roi in rois], dtype=np.bytes_)
+        
+        keys = list(rois[0]['kidney'].keys()) if len(rois) > 0 else []
+        self._kidney_rois = np.zeros(len(rois), dtype=[(k, np.int32) for k in keys])
+        for i, roi in enumerate(rois):
+            self._kidney_rois[i] = tuple(roi['kidney'][k] for k in keys)
+        del self._rois
     
     def idx_to_name(self, idx):
-        path = self._imgs[idx]
+        path = Path(self._img_path(idx))
         name = Path(path.parts[-3]) / Path(path.parts[-1][:-4])
         return name
     
     def vis_transform(self, data):
-        cmap = self.get_colormap()
+        # colormap already scaled to [0, 1], so the lookup is the only pass over labels
+        cmap = self._spec_cmap_float
         if 'image' in data.keys() and data['image'] is not None:
             imgs = data['image']
-            if type(imgs).__module__ != np.__name__:
-                imgs = imgs.cpu().detach().numpy()
+            if isinstance(imgs, torch.Tensor):
+                imgs = imgs.cpu().detach().float().numpy()
             data['image'] = imgs
         
         if 'label' in data.keys() and data['label'] is not None and data['label'].shape[-1] != 0:
             labels = data['label']
-            if type(labels).__module__ != np.__name__:
+            if isinstance(labels, torch.Tensor):
                 labels = labels.cpu().detach().numpy()
             labels = cmap[labels]
             labels = labels.transpose((0, 3, 1, 2))
-            labels = labels / 255
             data['label'] = labels
         
         if 'predict' in data.keys() and data['predict'] is not None:
             preds = data['predict']
-            if type(preds).__module__ != np.__name__:
+            if isinstance(preds, torch.Tensor):
                 preds = preds.cpu().detach().numpy()
             if preds.shape[1] == self.num_classes:
                 preds = preds.argmax(axis=1)
             preds = cmap[preds]
             preds = preds.transpose((0, 3, 1, 2))
-            preds = preds / 255
             data['predict'] = preds
         
         return data
     
     def _default_transform(self, data):
-        if (data['image'].shape[0], data['image'].shape[1]) != self._img_size:
+        if not self._defer_resize and (data['image'].shape[0], data['image'].shape[1]) != self._img_size:
             data = self._resize(data)
         
         image, label = data['image'], data['label']
         
-        image = image.astype(np.float32)
-        image = image.transpose((2, 0, 1))
-        image = torch.from_numpy(image)
+        # CHW view of HWC memory, i.e. the channels last layout collate_fn batches into;
+        # float16 halves the worker IPC and host to device bytes, upcast with .float() on GPU
+        image = np.ascontiguousarray(image, dtype=np.float16)
+        image = torch.from_numpy(image).permute(2, 0, 1)
         data['image'] = image
         
         if label is not None:
-            label = label.astype(np.int64)
-            
-            if self._spec_classes != [0, 1, 2]:
-                idx = list(range(len(self.get_classes_name(spec=False))))
-                masks = [np.where(label == i) for i in idx]
-                spec_class_idx = []
-                for i in self._spec_classes:
-                    if i not in spec_class_idx:
-                        spec_class_idx.append(i)
-                
-                for mask, spec_class in zip(masks, self._spec_classes):
-                    label[mask] = spec_class_idx.index(spec_class)
+            if self._label_lut is not None:
+                label = self._label_lut[label.astype(np.intp, copy=False)]
+            else:
+                label = label.astype(np.int64)
             
             label = torch.from_numpy(label)
             data['label'] = label
@@ -250,28 +346,93 @@ class KiTS19(data.Dataset):
         data = to_numpy(data)
         img, label = data['image'], data['label']
         
-        num = max(img.shape[0], img.shape[1])
+        shape = (img.shape[0], img.shape[1])
+        mat = self._resize_mats.get(shape)
+        if mat is None:
+            mat = self._get_resize_mat(shape)
+            self._resize_mats[shape] = mat
         
-        aug = Compose([
-            PadIfNeeded(min_height=num, min_width=num,
-                        border_mode=cv2.BORDER_CONSTANT, p=1),
-            Resize(height=self._img_size[0], width=self._img_size[1], p=1)
-        ])
+        # cv2.resize took any of these dtypes, cv2.warpAffine does not
+        if img.dtype not in _LINEAR_DTYPES:
+            img = img.astype(np.float32)
         
-        data = aug(image=img, mask=label)
-        img, label = data['image'], data['mask']
-        
-        data['image'] = img
-        data['label'] = label
+        dsize = (self._img_size[1], self._img_size[0])
+        data['image'] = _warp_affine(img, mat, dsize, cv2.INTER_LINEAR)
+        if label is not None:
+            data['label'] = self._resize_label(label, shape)
         return data
     
+    def _resize_label(self, label, shape):
+        indices = self._label_indices.get(shape)
+        if indices is None:
+            indices = self._get_label_indices(shape)
+            self._label_indices[shape] = indices
+        ys, xs, valid_y, valid_x = indices
+        
+        # rows and columns that land in the zero padding stay background
+        out = np.zeros(tuple(self._img_size) + label.shape[2:], dtype=label.dtype)
+        out[np.ix_(valid_y, valid_x)] = label[np.ix_(ys[valid_y], xs[valid_x])]
+        return out
+    
+    def _get_label_indices(self, shape):
+        # nearest neighbour with pixel centers aligned, floor((i + 0.5) * num / size) in integers,
+        # the same source pixels transform.pad_resize picks, whatever the label dtype
+        num = max(shape[0], shape[1])
+        ys = (2 * np.arange(self._img_size[0]) + 1) * num // (2 * self._img_size[0]) - (num - shape[0]) // 2
+        xs = (2 * np.arange(self._img_size[1]) + 1) * num // (2 * self._img_size[1]) - (num - shape[1]) // 2
+        return ys, xs, (ys >= 0) & (ys < shape[0]), (xs >= 0) & (xs < shape[1])
+    
+    def _get_resize_mat(self, shape):
+        # zero pad to a centered square, then scale to img_size, as a single affine map
+        num = max(shape[0], shape[1])
+        pad_y = (num - shape[0]) // 2
+        pad_x = (num - shape[1]) // 2
+        scale_y = self._img_size[0] / num
+        scale_x = self._img_size[1] / num
+        
+        # keep pixel centers aligned the same way cv2.resize does
+        mat = np.array([[scale_x, 0, scale_x * (pad_x + 0.5) - 0.5],
+                        [0, scale_y, scale_y * (pad_y + 0.5) - 0.5]], dtype=np.float64)
+        return mat
+    
+    def make_loader(self, type='train', batch_size=1, shuffle=False, num_threads=4, prefetch=2,
+                    pin_memory=False, drop_last=False):
+        assert type in ('train', 'valid', 'test')
+        if type == 'train':
+            subset = self._train_dataset
+        elif type == 'valid':
+            subset = self._valid_dataset
+        elif type == 'test':
+            subset = self._test_dataset
+        
+        sampler = data.RandomSampler(subset) if shuffle else data.SequentialSampler(subset)
+        return ThreadDataLoader(subset, batch_size=batch_size, sampler=sampler, collate_fn=self.collate_fn,
+                                num_threads=num_threads, prefetch=prefetch, pin_memory=pin_memory,
+                                drop_last=drop_last)
+    
+    @staticmethod
+    def collate_fn(batch):
+        images = [d['image'] for d in batch]
+        batch = data.dataloader.default_collate([{k: v for k, v in d.items() if k != 'image'} for d in batch])
+        
+        # stack straight into a channels last batch, preferred by cuDNN / oneDNN convolutions
+        n = len(images)
+        c, h, w = images[0].shape
+        dtype = images[0].dtype
+        if data.get_worker_info() is not None:
+            # allocated in shared memory right away, like default_collate does,
+            # so the batch goes to the main process without another copy
+            nbytes = n * c * h * w * images[0].element_size()
+            storage = torch.empty(0, dtype=dtype).untyped_storage()._new_shared(nbytes)
+            out = torch.empty(0, dtype=dtype).set_(storage, 0, (n, c, h, w), (c * h * w, 1, w * c, c))
+        else:
+            out = torch.empty((n, c, h, w), dtype=dtype, memory_format=torch.channels_last)
+        batch['image'] = torch.stack(images, out=out)
+        
+        return KiTSSample(batch)
+    
     def img_idx_to_case_idx(self, idx):
-        case_idx = 0
-        for i in range(len(self._case_slice_indices) - 1):
-            if self._case_slice_indices[i] <= idx < self._case_slice_indices[i + 1]:
-                case_idx = i
-                break
-        return case_idx
+        return int(self._idx2case[idx])
     
     def case_idx_to_case_id(self, case_idx, type='all'):
         if type == 'all':
@@ -285,50 +446,180 @@ class KiTS19(data.Dataset):
     
     def get_stack_img(self, idx):
         case_idx = self.img_idx_to_case_idx(idx)
-        imgs = []
-        for i in range(idx - self._stack_num // 2, idx + self._stack_num // 2 + 1):
-            if i < self._case_slice_indices[case_idx]:
-                i = self._case_slice_indices[case_idx]
-            elif i >= self._case_slice_indices[case_idx + 1]:
-                i = self._case_slice_indices[case_idx + 1] - 1
-            img_path = self._imgs[i]
-            img = np.load(str(img_path))
-            imgs.append(img)
-        img = np.stack(imgs, axis=2)
+        start = self._case_slice_indices[case_idx]
+        stop = self._case_slice_indices[case_idx + 1]
+        indices = [min(max(i, start), stop - 1)
+                   for i in range(idx - self._stack_num // 2, idx + self._stack_num // 2 + 1)]
+        # maps dataset indices of this case to z in the case volume
+        offset = self._case_min_z[case_idx] - start
+        
+        if self._volume_format is None:
+            shape, dtype, _ = self._get_npy_header(self._img_path(indices[0]))
+            img = np.empty((len(indices),) + shape, dtype=dtype)
+            for j, i in enumerate(indices):
+                if j > 0 and i == indices[j - 1]:
+                    img[j] = img[j - 1]
+                else:
+                    self._load_slice(self._img_path(i), out=img[j])
+            # slices are written as contiguous planes and handed on as an HWC view
+            img = img.transpose((1, 2, 0))
+        else:
+            # one contiguous read of the needed z range, edge slices repeated by indexing
+            vol = self._get_volume(case_idx, 'imaging')
+            block = vol[indices[0] + offset: indices[-1] + offset + 1]
+            img = block[np.array(indices) - indices[0]].transpose((1, 2, 0))
+            if img.dtype == np.float16:
+                # cv2 based transforms do not take float16
+                img = img.astype(np.float32)
         
+        return self._make_data(img, idx, case_idx)
+    
+    def _make_data(self, img, idx, case_idx):
         if idx in self._test_indices:
             label = None
+        elif self._volume_format is None:
+            label = self._load_slice(self._label_path(idx))
         else:
-            label_path = self._labels[idx]
-            label = np.load(str(label_path))
+            offset = self._case_min_z[case_idx] - self._case_slice_indices[case_idx]
+            label = self._get_volume(case_idx, 'segmentation')[idx + offset]
         
-        roi = self.get_roi(case_idx, type='all')['kidney'] if self._use_roi else {}
+        roi = {}
+        if self._use_roi:
+            kidney = self._kidney_rois[case_idx]
+            roi = dict(zip(kidney.dtype.names, kidney.tolist()))
         data = {'image': img, 'label': label, 'index': idx, 'roi': roi}
         
         return data
     
+    def _read_slice(self, idx, case_idx):
+        if self._volume_format is None:
+            return self._load_slice(self._img_path(idx))
+        
+        offset = self._case_min_z[case_idx] - self._case_slice_indices[case_idx]
+        img = self._get_volume(case_idx, 'imaging')[idx + offset]
+        if img.dtype == np.float16:
+            img = img.astype(np.float32)
+        return img
+    
+    def _load_slice(self, path, out=None):
+        if self._max_cache_bytes <= 0:
+            return self._fast_load(path, out)
+        
+        key = str(path)
+        with self._cache_lock:
+            arr = self._cache.get(key)
+            if arr is not None:
+                self._cache.move_to_end(key)
+        
+        if arr is None:
+            arr = self._fast_load(path)
+            arr.flags.writeable = False
+            with self._cache_lock:
+                if key not in self._cache:
+                    self._cache[key] = arr
+                    self._cache_bytes += arr.nbytes
+                    while self._cache_bytes > self._max_cache_bytes and len(self._cache) > 0:
+                        _, old = self._cache.popitem(last=False)
+                        self._cache_bytes -= old.nbytes
+        
+        if out is None:
+            return arr
+        out[...] = arr
+        return out
+    
+    def _fast_load(self, path, out=None):
+        shape, dtype, offset = self._get_npy_header(path)
+        if out is None:
+            out = np.empty(shape, dtype=dtype)
+        
+        if offset is None:
+            out[...] = np.load(str(path))
+            return out
+        
+        # the header was parsed once for the whole directory, read only the raw data
+        with open(str(path), 'rb', buffering=0) as f:
+            f.seek(offset)
+            num_bytes = f.readinto(memoryview(out).cast('B'))
+        assert num_bytes == out.nbytes
+        return out
+    
+    def _get_npy_header(self, path):
+        # all slices in a directory are saved from one volume and share dtype, shape and header size
+        key = os.path.dirname(str(path))
+        header = self._npy_headers.get(key)
+        if header is None:
+            with open(str(path), 'rb') as f:
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+                else:
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+                offset = f.tell()
+            if fortran_order or dtype.hasobject:
+                offset = None
+            header = (shape, dtype, offset)
+            self._npy_headers[key] = header
+        return header
+    
+    def _get_volume(self, case_idx, name):
+        key = (case_idx, name)
+        # blosc2 decompression contexts are not thread safe, every thread opens its own handles
+        volumes = getattr(self._local, 'volumes', None)
+        if volumes is None:
+            volumes = self._local.volumes = {}
+        vol = volumes.get(key)
+        if vol is None:
+            case_id = self._case_id[case_idx]
+            vol_file = self._root / f'case_{case_id:05d}' / f'{name}.{self._volume_format}'
+            assert vol_file.exists()
+            
+            if self._volume_format == 'b2nd':
+                import blosc2
+                vol = blosc2.open(str(vol_file), mode='r', mmap_mode='r')
+            else:
+                from safetensors import safe_open
+                vol = safe_open(str(vol_file), framework='numpy').get_slice('volume')
+            volumes[key] = vol
+        return vol
+    
     def get_roi(self, case_idx, type='all'):
-        case_id = self.case_idx_to_case_id(case_idx, type)
-        roi = self._rois[f'case_{case_id:05d}']
+        if type == 'valid':
+            case_idx += len(self._train_case)
+        elif type == 'test':
+            case_idx += len(self._train_case) + len(self._valid_case)
+        roi = json.loads(self._roi_strs[case_idx].decode())
         
         return roi
     
     def __getitem__(self, idx):
         data = self.get_stack_img(idx)
-        
-        if idx in self._train_indices and self._train_transform is not None:
-            data = self._train_transform(data)
-        elif idx in self._valid_indices and self._valid_transform is not None:
-            data = self._valid_transform(data)
-        elif idx in self._test_indices and self._test_transform is not None:
-            data = self._test_transform(data)
+        return self._transform(data)
+    
+    def _transform(self, data):
+        transform = self._transform_for_idx[data['index']]
+        if transform is not None:
+            data = transform(data)
         
         data = self._default_transform(data)
         
-        return data
+        return KiTSSample(data)
     
     def __len__(self):
-        return len(self._imgs)
+        return len(self._img_paths)
+    
+    def __getstate__(self):
+        # every DataLoader worker process starts with its own empty cache and volume handles
+        state = self.__dict__.copy()
+        state['_cache'] = collections.OrderedDict()
+        state['_cache_bytes'] = 0
+        del state['_cache_lock']
+        del state['_local']
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._cache_lock = threading.Lock()
+        self._local = threading.local()
     
     @property
     def img_channels(self):
@@ -383,6 +674,74 @@ class KiTS19(data.Dataset):
         return self._test_case
 
 
+class KiTS19Iter(data.IterableDataset):
+    # streams the cases of one subset slice by slice, keeping the last img_channels slices,
+    # so every slice is read once per pass instead of stack_num times
+    def __init__(self, dataset, type='train', shuffle=False):
+        assert type in ('train', 'valid', 'test')
+        self._dataset = dataset
+        self._type = type
+        self._shuffle = shuffle
+        # passes started by this copy, persistent workers keep their copy across epochs
+        self._epoch = 0
+    
+    def _cases(self):
+        num_train = len(self._dataset.train_case)
+        num_valid = len(self._dataset.valid_case)
+        num_test = len(self._dataset.test_case)
+        if self._type == 'train':
+            return range(0, num_train)
+        elif self._type == 'valid':
+            return range(num_train, num_train + num_valid)
+        elif self._type == 'test':
+            return range(num_train + num_valid, num_train + num_valid + num_test)
+    
+    def __iter__(self):
+        cases = list(self._cases())
+        
+        epoch = self._epoch
+        self._epoch += 1
+        
+        worker_info = data.get_worker_info()
+        if worker_info is None:
+            rng = np.random
+        else:
+            # same case order in every worker of this epoch, each worker takes its own share;
+            # the base seed is fixed for persistent workers, the epoch makes every pass reshuffle
+            rng = np.random.RandomState([(worker_info.seed - worker_info.id) % 2 ** 32, epoch])
+        if self._shuffle:
+            rng.shuffle(cases)
+        if worker_info is not None:
+            cases = cases[worker_info.id::worker_info.num_workers]
+        
+        for case_idx in cases:
+            yield from self._iter_case(case_idx)
+    
+    def _iter_case(self, case_idx):
+        dataset = self._dataset
+        start = dataset._case_slice_indices[case_idx]
+        stop = dataset._case_slice_indices[case_idx + 1]
+        half = dataset._stack_num // 2
+        
+        # the same 2 * half + 1 slices around idx that get_stack_img stacks
+        window = collections.deque(maxlen=2 * half + 1)
+        last_i, last_img = None, None
+        for j in range(start - half, stop + half):
+            i = min(max(j, start), stop - 1)
+            if i != last_i:
+                last_i, last_img = i, dataset._read_slice(i, case_idx)
+            window.append(last_img)
+            
+            if len(window) == window.maxlen:
+                idx = j - half
+                img = np.stack(window, axis=2)
+                yield dataset._transform(dataset._make_data(img, idx, case_idx))
+    
+    def __len__(self):
+        cases = self._cases()
+        return self._dataset._case_slice_indices[cases.stop] - self._dataset._case_slice_indices[cases.start]
+
+
 import click
 
 
@@ -404,7 +763,7 @@ def main(data_path):
     
     subset = dataset.train_dataset
     sampler = SequentialSampler(subset)
-    data_loader = DataLoader(subset, batch_size=1, sampler=sampler)
+    data_loader = DataLoader(subset, batch_size=1, sampler=sampler, collate_fn=dataset.collate_fn)
     
     for batch_idx, data in enumerate(data_loader):
         data = dataset.vis_transform(data)
@@ -0,0 +1,64 @@
+import collections
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+from torch.utils import data
+from torch.utils.data._utils.pin_memory import pin_memory
+
+
+class ThreadDataLoader:
+    # loads samples on a thread pool of the main process instead of worker processes,
+    # nothing is forked or pickled and file reads, numpy and cv2 release the GIL
+    def __init__(self, dataset, batch_size=1, sampler=None, collate_fn=None,
+                 num_threads=4, prefetch=2, pin_memory=False, drop_last=False):
+        if sampler is None:
+            sampler = data.SequentialSampler(dataset)
+        if collate_fn is None:
+            collate_fn = data.dataloader.default_collate
+        
+        self._dataset = dataset
+        self._batch_sampler = data.BatchSampler(sampler, batch_size, drop_last)
+        self._collate_fn = collate_fn
+        self._num_threads = num_threads
+        self._prefetch = prefetch
+        self._pin_memory = pin_memory
+    
+    def __iter__(self):
+        with ThreadPoolExecutor(max_workers=self._num_threads) as executor:
+            # up to prefetch batches are loading while the current one is consumed
+            pending = collections.deque()
+            for indices in self._batch_sampler:
+                pending.append([executor.submit(self._dataset.__getitem__, i) for i in indices])
+                if len(pending) > self._prefetch:
+                    yield self._collate(pending.popleft())
+            
+            while len(pending) > 0:
+                yield self._collate(pending.popleft())
+    
+    def _collate(self, futures):
+        batch = self._collate_fn([f.result() for f in futures])
+        if self._pin_memory:
+            batch = pin_memory(batch)
+        return batch
+    
+    def __len__(self):
+        return len(self._batch_sampler)
+
+
+class CaseBatchSampler(data.Sampler):
+    # sequential batches that never span two cases, so all slices of a batch share their
+    # in-plane size and can be collated before resizing (KiTS19 with defer_resize=True)
+    def __init__(self, case_slice_indices, batch_size):
+        self._case_slice_indices = case_slice_indices
+        self._batch_size = batch_size
+    
+    def __iter__(self):
+        # case_slice_indices are dataset indices, batches index into the subset
+        offset = self._case_slice_indices[0]
+        for start, stop in zip(self._case_slice_indices[:-1], self._case_slice_indices[1:]):
+            for i in range(start, stop, self._batch_size):
+                yield list(range(i - offset, min(i + self._batch_size, stop) - offset))
+    
+    def __len__(self):
+        return sum(math.ceil((stop - start) / self._batch_size)
+                   for start, stop in zip(self._case_slice_indices[:-1], self._case_slice_indices[1:]))
@@ -1,5 +1,7 @@
 import cv2
 import numpy as np
+import torch
+import torch.nn.functional as F
 from albumentations import Compose as Compose_albu
 from albumentations import (
     PadIfNeeded,
@@ -7,7 +9,6 @@ from albumentations import (
     GridDistortion,
     RandomBrightnessContrast,
     RandomGamma,
-    Crop,
     LongestMaxSize,
     ShiftScaleRotate
 )
@@ -21,6 +22,24 @@ def to_numpy(data):
     return data
 
 
+def pad_resize(image, label=None, size=(512, 512)):
+    # batched tensor version of the KiTS19 resize (centered zero pad to square, then resize),
+    # meant to run on GPU for datasets created with defer_resize=True
+    h, w = image.shape[-2], image.shape[-1]
+    num = max(h, w)
+    pad_y = (num - h) // 2
+    pad_x = (num - w) // 2
+    pad = (pad_x, num - w - pad_x, pad_y, num - h - pad_y)
+    
+    image = F.interpolate(F.pad(image, pad), size=size, mode='bilinear', align_corners=False)
+    if label is not None and label.numel() != 0:
+        # same integer nearest neighbour indices as KiTS19._resize_label
+        ys = (2 * torch.arange(size[0], device=label.device) + 1) * num // (2 * size[0])
+        xs = (2 * torch.arange(size[1], device=label.device) + 1) * num // (2 * size[1])
+        label = F.pad(label, pad)[:, ys][:, :, xs]
+    return image, label
+
+
 class Compose:
     def __init__(self, transforms):
         self.transforms = transforms
@@ -41,6 +60,7 @@ class MedicalTransform:
         self._roi_error_range = roi_error_range
         self._type = 'train'
         self.use_roi = use_roi
+        self._augs = {}
     
     def train(self):
         self._type = 'train'
@@ -50,11 +70,11 @@ class MedicalTransform:
         self._type = 'eval'
         return self
     
-    def __call__(self, data):
-        data = to_numpy(data)
-        img, label = data['image'], data['label']
-        
-        is_3d = True if img.shape == 4 else False
+    def _get_aug(self):
+        # the pipelines only depend on the mode, build each once and reuse it for every sample
+        aug = self._augs.get(self._type)
+        if aug is not None:
+            return aug
         
         max_size = max(self._output_size[0], self._output_size[1])
         
@@ -75,6 +95,16 @@ class MedicalTransform:
                 PadIfNeeded(self._output_size[0], self._output_size[1], cv2.BORDER_CONSTANT, value=0, p=1)
             ]
         
+        aug = Compose_albu(task)
+        self._augs[self._type] = aug
+        return aug
+    
+    def __call__(self, data):
+        data = to_numpy(data)
+        img, label = data['image'], data['label']
+        
+        is_3d = True if img.shape == 4 else False
+        
         if self.use_roi:
             assert 'roi' in data.keys() and len(data['roi']) is not 0
             roi = data['roi']
@@ -87,10 +117,12 @@ class MedicalTransform:
             min_y = max(min_y, roi['min_y'] - self._roi_error_range)
             max_y = min(max_y, roi['max_y'] + self._roi_error_range)
             
-            crop = [Crop(min_x, min_y, max_x, max_y, p=1)]
-            task = crop + task
+            # same as albumentations Crop, which would tie the pipeline to one roi
+            img = img[min_y:max_y, min_x:max_x]
+            if label is not None:
+                label = label[min_y:max_y, min_x:max_x]
         
-        aug = Compose_albu(task)
+        aug = self._get_aug()
         if not is_3d:
             aug_data = aug(image=img, mask=label)
             data['image'], data['label'] = aug_data['image'], aug_data['mask']
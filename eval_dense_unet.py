@@ -75,14 +75,14 @@ def main(batch_size, num_gpu, img_size, data_path, resume, output_path, vis_intv
     
     sampler = SequentialSampler(subset)
     data_loader = DataLoader(subset, batch_size=batch_size, sampler=sampler,
-                             num_workers=num_workers, pin_memory=True)
+                             num_workers=num_workers, pin_memory=True, collate_fn=dataset.collate_fn)
     
     case = 0
     vol_output = []
     
     with tqdm(total=len(case_slice_indices) - 1, ascii=True, desc=f'eval/test', dynamic_ncols=True) as pbar:
         for batch_idx, data in enumerate(data_loader):
-            imgs, idx = data['image'].cuda(), data['index']
+            imgs, idx = data['image'].cuda(non_blocking=True).float(), data['index']
             
             outputs = net(imgs)
             predicts = outputs['output']
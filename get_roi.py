@@ -6,12 +6,12 @@ import nibabel as nib
 import numpy as np
 import torch
 from pathlib2 import Path
-from torch.utils.data import DataLoader, SequentialSampler
+from torch.utils.data import DataLoader
 from tqdm import tqdm
 
 import utils.checkpoint as cp
-from dataset import KiTS19
-from dataset.transform import MedicalTransform
+from dataset import CaseBatchSampler, KiTS19
+from dataset.transform import MedicalTransform, pad_resize
 from network import ResUNet
 from utils.vis import imshow
 
@@ -84,8 +84,9 @@ def get_roi_from_resunet(batch_size, num_gpu, img_size, data_path, resume, roi_f
     
     transform = MedicalTransform(output_size=img_size, roi_error_range=15, use_roi=False)
     
+    # test slices are resized on GPU after the copy instead of in the loader
     dataset = KiTS19(data_path, stack_num=5, spec_classes=[0, 1, 1], img_size=img_size,
-                     use_roi=False, train_transform=transform, valid_transform=transform)
+                     use_roi=False, train_transform=transform, valid_transform=transform, defer_resize=True)
     
     net = ResUNet(in_ch=dataset.img_channels, out_ch=dataset.num_classes, base_ch=64)
     
@@ -107,16 +108,17 @@ def get_roi_from_resunet(batch_size, num_gpu, img_size, data_path, resume, roi_f
     subset = dataset.test_dataset
     case_slice_indices = dataset.test_case_slice_indices
     
-    sampler = SequentialSampler(subset)
-    data_loader = DataLoader(subset, batch_size=batch_size, sampler=sampler,
-                             num_workers=num_workers, pin_memory=True)
+    batch_sampler = CaseBatchSampler(case_slice_indices, batch_size)
+    data_loader = DataLoader(subset, batch_sampler=batch_sampler,
+                             num_workers=num_workers, pin_memory=True, collate_fn=dataset.collate_fn)
     
     case = 0
     vol_output = []
     
     with tqdm(total=len(case_slice_indices) - 1, ascii=True, desc=f'eval/test', dynamic_ncols=True) as pbar:
         for batch_idx, data in enumerate(data_loader):
-            imgs, idx = data['image'].cuda(), data['index']
+            imgs, idx = data['image'].cuda(non_blocking=True).float(), data['index']
+            imgs, _ = pad_resize(imgs, size=img_size)
             
             predicts = net(imgs)
             predicts = predicts.argmax(dim=1)
@@ -143,6 +145,7 @@ def get_roi_from_resunet(batch_size, num_gpu, img_size, data_path, resume, roi_f
                 pbar.update(1)
             
             if vis_intvl > 0 and batch_idx % vis_intvl == 0:
+                data['image'] = imgs
                 data['predict'] = predicts
                 data = dataset.vis_transform(data)
                 imgs, predicts = data['image'], data['predict']
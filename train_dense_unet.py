@@ -165,11 +165,11 @@ def training(net, dataset, criterion, optimizer, scheduler, epoch, batch_size, n
     sampler = RandomSampler(dataset.train_dataset)
     
     train_loader = DataLoader(dataset.train_dataset, batch_size=batch_size, sampler=sampler,
-                              num_workers=num_workers, pin_memory=True)
+                              num_workers=num_workers, pin_memory=True, collate_fn=dataset.collate_fn)
     
     tbar = tqdm(train_loader, ascii=True, desc='train', dynamic_ncols=True)
     for batch_idx, data in enumerate(tbar):
-        imgs, labels = data['image'].cuda(), data['label'].cuda()
+        imgs, labels = data['image'].cuda(non_blocking=True).float(), data['label'].cuda(non_blocking=True)
         outputs = net(imgs)
         
         losses = {}
@@ -220,7 +220,7 @@ def evaluation(net, dataset, epoch, batch_size, num_workers, vis_intvl, logger,
     
     sampler = SequentialSampler(subset)
     data_loader = DataLoader(subset, batch_size=batch_size, sampler=sampler,
-                             num_workers=num_workers, pin_memory=True)
+                             num_workers=num_workers, pin_memory=True, collate_fn=dataset.collate_fn)
     evaluator = Evaluator(dataset.num_classes)
     
     case = 0
@@ -229,7 +229,7 @@ def evaluation(net, dataset, epoch, batch_size, num_workers, vis_intvl, logger,
     
     with tqdm(total=len(case_slice_indices) - 1, ascii=True, desc=f'eval/{type:5}', dynamic_ncols=True) as pbar:
         for batch_idx, data in enumerate(data_loader):
-            imgs, labels, idx = data['image'].cuda(), data['label'], data['index']
+            imgs, labels, idx = data['image'].cuda(non_blocking=True).float(), data['label'], data['index']
             
             outputs = net(imgs)
             predicts = outputs['output']